@@ -21,7 +21,13 @@
 
 import binaryninja as binja
 
+import concurrent.futures
+import contextlib
+import functools
+import os
+import struct as structmod
 import sys
+import threading
 import traceback
 
 from . import shinobi
@@ -39,6 +45,20 @@ def is_valid(bv, arg=None):
 
 _TYPE_ID_SOURCE = "binja-blocks"
 
+_DEBUG = os.environ.get("BINJA_BLOCKS_DEBUG")
+
+
+def _exc_detail():
+    """
+    Full traceback for error messages when BINJA_BLOCKS_DEBUG is set in
+    the environment, empty string otherwise.  Formatting a traceback
+    walks every frame and is wasted work on binaries where many blocks
+    fail to annotate.
+    """
+    if _DEBUG:
+        return "\n" + traceback.format_exc()
+    return ""
+
 
 _OBJC_TYPE_SOURCE = """
 struct objc_class {
@@ -154,14 +174,119 @@ BLOCK_LAYOUT_WEAK               = 0x5   # lo nibble # weak pointers
 BLOCK_LAYOUT_UNRETAINED         = 0x6   # lo nibble # unretained pointers
 
 
+# Right-hand-side HLIL classes seen on assignments into a stack block
+# literal.  Exact type dispatch instead of an 8-way isinstance tuple;
+# this check runs for every field assignment of every stack block.
+# HighLevelILStructField is typically because of Binja bug treating
+# d8-15/v8-15 as caller-saved instead of callee-saved.
+# HighLevelILVar is typically a byref passed as argument.
+_BYREF_SRC_ADDROF = binja.HighLevelILAddressOf
+_BYREF_SRC_SKIP = frozenset({
+    binja.HighLevelILDerefField,
+    binja.HighLevelILDeref,
+    binja.HighLevelILImport,
+    binja.HighLevelILConst,
+    binja.HighLevelILConstPtr,
+    binja.HighLevelILCall,
+    binja.HighLevelILStructField,
+    binja.HighLevelILVar,
+})
+
+
+# Cache for _get_custom_type, keyed by (id(bv), name).  The types we
+# look up are defined once and never change, but the lookups happen for
+# every struct field append on every block, each a round-trip into the
+# Binja core.
+_TYPE_CACHE = {}
+
+
+def _clear_type_cache(bv):
+    """
+    Drop all cached type lookups for a view.
+    Called once per plugin command invocation in case the user
+    removed or redefined any of the types we rely on.
+    """
+    bv_id = id(bv)
+    for cache in (_TYPE_CACHE, _CTYPE_CACHE, _PARSED_TYPE_CACHE, _SYMBOL_CACHE):
+        for key in [key for key in cache if key[0] == bv_id]:
+            del cache[key]
+    _PRIM_TYPES.pop(bv_id, None)
+    layout_cache = getattr(bv, '_block_layout_cache', None)
+    if layout_cache is not None:
+        layout_cache.clear()
+
+
 def _get_custom_type(bv, name, source):
+    cache_key = (id(bv), name)
+    type_ = _TYPE_CACHE.get(cache_key)
+    if type_ is not None:
+        return type_
     type_ = bv.get_type_by_name(name)
     if type_ is not None:
+        _TYPE_CACHE[cache_key] = type_
         return type_
     types = bv.parse_types_from_string(source)
     bv.define_types([(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, k), k, v) for k, v in types.types.items()], None)
     type_ = bv.get_type_by_name(name)
     assert type_ is not None
+    _TYPE_CACHE[cache_key] = type_
+    return type_
+
+
+# Primitive types used over and over in block structs, keyed by id(bv).
+# Constructed once per plugin command invocation; going through the type
+# parser for every block is dramatically more expensive than reusing the
+# Type objects.  Evicted with the other caches so that a recycled object
+# id of a closed view cannot serve stale Type objects to a new view.
+_PRIM_TYPES = {}
+
+
+def _get_prim_types(bv):
+    prims = _PRIM_TYPES.get(id(bv))
+    if prims is None:
+        prims = {
+            'uint8_t': binja.Type.int(1, sign=False),
+            'uint32_t': binja.Type.int(4, sign=False),
+            'uint64_t': binja.Type.int(8, sign=False),
+            'volatile uint32_t': bv.parse_type_string("volatile uint32_t")[0],
+            'char const *': bv.parse_type_string("char const *")[0],
+            'uint8_t const *': bv.parse_type_string("uint8_t const *")[0],
+            'void *': binja.Type.pointer(bv.arch, binja.Type.void()),
+        }
+        _PRIM_TYPES[id(bv)] = prims
+    return prims
+
+
+# Cache for _get_symbol_of_type, keyed by (id(bv), name, symbol type).
+# The libclosure runtime symbols never move within a session, but
+# resolving them walks and filters the view's symbol list; the global
+# block sweep did this once per block literal.  Only successful lookups
+# are cached so that symbols defined later are still picked up.
+_SYMBOL_CACHE = {}
+
+
+def _get_symbol_of_type(bv, name, type_):
+    cache_key = (id(bv), name, type_)
+    sym = _SYMBOL_CACHE.get(cache_key)
+    if sym is None:
+        sym = shinobi.get_symbol_of_type(bv, name, type_)
+        if sym is not None:
+            _SYMBOL_CACHE[cache_key] = sym
+    return sym
+
+
+# Cache for _parsed_type, keyed by (id(bv), type string).  The byref
+# annotation loop parses the same handful of type strings for every
+# byref of every block; each parse invokes the full type parser.
+_PARSED_TYPE_CACHE = {}
+
+
+def _parsed_type(bv, type_string):
+    cache_key = (id(bv), type_string)
+    type_ = _PARSED_TYPE_CACHE.get(cache_key)
+    if type_ is None:
+        type_ = bv.parse_type_string(type_string)[0]
+        _PARSED_TYPE_CACHE[cache_key] = type_
     return type_
 
 
@@ -186,20 +311,161 @@ def _get_libclosure_type(bv, name):
     return _get_custom_type(bv, name, _LIBCLOSURE_TYPE_SOURCE)
 
 
+# Serializes all mutation of the type table and of shared struct
+# builders when blocks are annotated from multiple worker threads.
+# Reentrant because resolving a pending struct type flushes the batch.
+_TYPE_TABLE_LOCK = threading.RLock()
+
+
+class BlockSweepContext:
+    """
+    Collects struct definitions during a sweep over many blocks and
+    flushes them to the view in batches, amortizing the cost of
+    define_types and the analysis invalidation it triggers.
+    First-time definitions are flushed before the name is resolved,
+    since a type must be in the type table before it can be referenced
+    by name; re-definitions of already-registered structs stay pending
+    until the next batch or the end of the sweep.
+    """
+
+    BATCH_SIZE = 256
+    SYNC_BATCH_SIZE = 16
+
+    def __init__(self, bv):
+        self._bv = bv
+        self._pending = []
+        self._pending_names = set()
+        self.pending_syncs = 0
+
+    def define_struct(self, name, builder):
+        with _TYPE_TABLE_LOCK:
+            self._pending.append((binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, name), name, builder))
+            self._pending_names.add(name)
+            if len(self._pending) >= self.BATCH_SIZE:
+                self.flush()
+
+    def resolve_struct_type(self, name):
+        with _TYPE_TABLE_LOCK:
+            if name in self._pending_names and self._bv.get_type_by_name(name) is None:
+                self.flush()
+        return binja.Type.named_type_from_registered_type(self._bv, name)
+
+    def flush(self):
+        with _TYPE_TABLE_LOCK:
+            if len(self._pending) > 0:
+                self._bv.define_types(self._pending, None)
+                self._pending.clear()
+                self._pending_names.clear()
+
+
+@contextlib.contextmanager
+def _block_sweep(bv):
+    """
+    Install a BlockSweepContext on the view for the duration of a sweep.
+    Reuses an already-installed context so that nested sweeps share one
+    batch.
+    """
+    ctx = getattr(bv, '_block_sweep_ctx', None)
+    if ctx is not None:
+        yield ctx
+        return
+    ctx = BlockSweepContext(bv)
+    bv._block_sweep_ctx = ctx
+    try:
+        yield ctx
+    finally:
+        bv._block_sweep_ctx = None
+        ctx.flush()
+        if ctx.pending_syncs > 0:
+            bv.update_analysis_and_wait()
+            ctx.pending_syncs = 0
+
+
+def _request_analysis_sync(bv):
+    """
+    Update analysis and wait, batched when a sweep is active.
+    Only for call sites that do not read analysis results back
+    before the next block is processed; syncs whose results are
+    needed immediately must keep calling update_analysis_and_wait
+    directly.
+    """
+    ctx = getattr(bv, '_block_sweep_ctx', None)
+    if ctx is None:
+        bv.update_analysis_and_wait()
+        return
+    with _TYPE_TABLE_LOCK:
+        ctx.pending_syncs += 1
+        if ctx.pending_syncs < BlockSweepContext.SYNC_BATCH_SIZE:
+            return
+        ctx.pending_syncs = 0
+    bv.update_analysis_and_wait()
+
+
+def _define_struct(bv, name, builder):
+    """
+    Register a struct under name, batched when a sweep is active.
+    """
+    ctx = getattr(bv, '_block_sweep_ctx', None)
+    if ctx is not None:
+        ctx.define_struct(name, builder)
+    else:
+        with _TYPE_TABLE_LOCK:
+            bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, name), name, builder)
+
+
+def _resolve_struct_type(bv, name):
+    """
+    Get a named reference Type for a struct registered through
+    _define_struct, without going through the type parser.
+    """
+    ctx = getattr(bv, '_block_sweep_ctx', None)
+    if ctx is not None:
+        return ctx.resolve_struct_type(name)
+    return binja.Type.named_type_from_registered_type(bv, name)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_signature(signature_raw):
+    """
+    Parse an ObjC encoded type signature into a tuple of C type strings.
+    Memoized because many descriptors carry identical signatures and the
+    parse is pure Python.
+    """
+    return tuple(objctypes.ObjCEncodedTypes(signature_raw).ctypes)
+
+
+# Cache for BlockLiteral._type_for_ctype, keyed by (id(bv), ctype).
+_CTYPE_CACHE = {}
+
+
+def _has_auto_name(func):
+    """
+    Check whether a function still carries the default sub_<addr> name.
+    The prefix test avoids formatting the address for the common case of
+    functions that have already been renamed.
+    """
+    name = func.name
+    return name.startswith("sub_") and name == f"sub_{func.start:x}"
+
+
 def _define_ns_concrete_block_imports(bv):
     """
     For some reason, Binary Ninja does not reliably define all external symbols.
     Make sure __NSConcreteGlobalBlock and __NSConcreteStackBlock are defined
     appropriately.
+    Only does the work once per view; subsequent calls are no-ops.
     """
+    if getattr(bv, '_ns_concrete_defined', False):
+        return
     class_type = _get_objc_type(bv, "Class")
     for sym_name in ("__NSConcreteGlobalBlock", "__NSConcreteStackBlock"):
-        ext_sym = shinobi.get_symbol_of_type(bv, sym_name, binja.SymbolType.ExternalSymbol)
+        ext_sym = _get_symbol_of_type(bv, sym_name, binja.SymbolType.ExternalSymbol)
         if ext_sym is None:
             return
         shinobi.make_data_var(bv,
                               ext_sym.address,
                               class_type)
+    bv._ns_concrete_defined = True
 
 
 def append_layout_fields(bv, struct, layout, block_has_extended_layout, byref_indexes=None, layout_end_obj=None):
@@ -215,69 +481,117 @@ def append_layout_fields(bv, struct, layout, block_has_extended_layout, byref_in
     if not block_has_extended_layout:
         # XXX
         return
+    # Hoist type lookups out of the loops; each lookup is a round-trip
+    # into the Binja core and layouts can describe many pointers.
+    id_type = _get_objc_type(bv, "id")
+    prims = _get_prim_types(bv)
+    # Track the field offset locally instead of querying struct.width
+    # for every appended member.  For packed structs (the literal)
+    # offsets are simply cumulative; for unpacked structs (byrefs) the
+    # builder aligns 8-byte members, so round up before appending them
+    # to keep the offset-derived names accurate.  All appended pointers
+    # are 8 bytes wide.
+    off = struct.width
+    packed = struct.packed
     if layout < 0x1000:
         # compact encoding
+        if not packed:
+            off = (off + 7) & ~7
         n_strong_ptrs = (layout >> 8) & 0xf
         n_byref_ptrs = (layout >> 4) & 0xf
         n_weak_ptrs = layout & 0xf
-        for _ in range(n_strong_ptrs):
-            struct.append(_get_objc_type(bv, "id"), f"strong_ptr_{struct.width:x}")
-        for _ in range(n_byref_ptrs):
-            if byref_indexes is not None:
-                byref_indexes.append(len(struct.members))
-            struct.append(_get_objc_type(bv, "id"), f"byref_ptr_{struct.width:x}")
-        for _ in range(n_weak_ptrs):
-            struct.append(_get_objc_type(bv, "id"), f"weak_ptr_{struct.width:x}")
+        for kind, n in (("strong_ptr", n_strong_ptrs),
+                        ("byref_ptr", n_byref_ptrs),
+                        ("weak_ptr", n_weak_ptrs)):
+            for _ in range(n):
+                if kind == "byref_ptr" and byref_indexes is not None:
+                    byref_indexes.append(len(struct.members))
+                struct.append(id_type, f"{kind}_{off:x}")
+                off += 8
     else:
         # bytecode encoding
-        br = binja.BinaryReader(bv)
-        br.seek(layout)
+        u64_type = prims['uint64_t']
+        u8_array_types = {}
+        # Read the bytecode in bulk instead of one byte per opcode;
+        # layouts are short, so a single read covers all but degenerate
+        # cases.
+        buf = bv.read(layout, 256)
+        i = 0
         while True:
-            op = br.read8()
+            if i >= len(buf):
+                more = bv.read(layout + len(buf), 256)
+                if len(more) == 0:
+                    print(f"Warning: No terminator in extended layout bytecode at {layout:#x}")
+                    break
+                buf += more
+            op = buf[i]
+            i += 1
             opcode = (op & 0xf0) >> 4
             oparg = (op & 0x0f)
+            if not packed and opcode not in (BLOCK_LAYOUT_ESCAPE,
+                                             BLOCK_LAYOUT_NON_OBJECT_BYTES):
+                # every opcode but the byte run appends 8-byte members
+                off = (off + 7) & ~7
             if opcode == BLOCK_LAYOUT_ESCAPE:
                 break
             elif opcode == BLOCK_LAYOUT_NON_OBJECT_BYTES:
-                struct.append(bv.parse_type_string(f"uint8_t [{oparg}]")[0], f"non_object_{struct.width:x}")
+                u8_array_type = u8_array_types.get(oparg)
+                if u8_array_type is None:
+                    u8_array_type = binja.Type.array(prims['uint8_t'], oparg)
+                    u8_array_types[oparg] = u8_array_type
+                struct.append(u8_array_type, f"non_object_{off:x}")
+                off += oparg
             elif opcode == BLOCK_LAYOUT_NON_OBJECT_WORDS:
                 for _ in range(oparg):
-                    struct.append(bv.parse_type_string(f"uint64_t")[0], f"non_object_{struct.width:x}")
+                    struct.append(u64_type, f"non_object_{off:x}")
+                    off += 8
             elif opcode == BLOCK_LAYOUT_STRONG:
                 for _ in range(oparg):
-                    struct.append(_get_objc_type(bv, "id"), f"strong_ptr_{struct.width:x}")
+                    struct.append(id_type, f"strong_ptr_{off:x}")
+                    off += 8
             elif opcode == BLOCK_LAYOUT_BYREF:
                 for _ in range(oparg):
                     if byref_indexes is not None:
                         byref_indexes.append(len(struct.members))
-                    struct.append(_get_objc_type(bv, "id"), f"byref_ptr_{struct.width:x}")
+                    struct.append(id_type, f"byref_ptr_{off:x}")
+                    off += 8
             elif opcode == BLOCK_LAYOUT_WEAK:
                 for _ in range(oparg):
-                    struct.append(_get_objc_type(bv, "id"), f"weak_ptr_{struct.width:x}")
+                    struct.append(id_type, f"weak_ptr_{off:x}")
+                    off += 8
             elif opcode == BLOCK_LAYOUT_UNRETAINED:
                 for _ in range(oparg):
-                    struct.append(_get_objc_type(bv, "id"), f"unretained_ptr_{struct.width:x}")
+                    struct.append(id_type, f"unretained_ptr_{off:x}")
+                    off += 8
             else:
                 print(f"Warning: Unknown extended layout op {op:#04x}")
                 break
         if layout_end_obj is not None:
-            layout_end_obj.layout_end = br.offset
+            layout_end_obj.layout_end = layout + i
 
 
 class BlockLiteral:
+    # One instance per block; on annotate-all runs over thousands of
+    # blocks, slots avoid the per-instance dict and speed up the
+    # attribute accesses in the annotation loops.
+    __slots__ = (
+        "_bv", "is_stack_block", "insn", "data_var", "address",
+        "isa", "flags", "reserved", "invoke", "descriptor",
+        "byref_indexes", "struct_builder", "struct_name",
+        "struct_type_name", "struct_type",
+        "_invoke_index", "_descriptor_index",
+    )
+
     @classmethod
     def from_data(cls, bv, bl_data_var):
         """
         Read block literal from data.
         """
         is_stack_block = False
-        br = binja.BinaryReader(bv)
-        br.seek(bl_data_var.address)
-        isa = br.read64()
-        flags = br.read32()
-        reserved = br.read32()
-        invoke = br.read64()
-        descriptor = br.read64()
+        # Read the whole 32 byte header in one go; all targets are
+        # little-endian.
+        buf = bv.read(bl_data_var.address, 0x20)
+        isa, flags, reserved, invoke, descriptor = structmod.unpack_from("<QIIQQ", buf)
         return cls(bv, is_stack_block, bl_data_var, isa, flags, reserved, invoke, descriptor)
 
     @classmethod
@@ -298,30 +612,40 @@ class BlockLiteral:
         else:
             raise RuntimeError(f"bl_insn after reload is unexpected type {type(bl_insn).__name__}")
 
-        for insn in shinobi.yield_struct_field_assign_hlil_instructions_for_var_id(bl_insn.function, stack_var_id):
+        # Bitmask of the member indexes seen so far, so we can stop as
+        # soon as isa, flags, reserved, invoke and descriptor have all
+        # been captured.
+        got = 0
+        field_assigns_by_var_id = shinobi.build_struct_field_assign_index(bl_insn.function)
+        for insn in field_assigns_by_var_id.get(stack_var_id, ()):
             if insn.dest.member_index == 0:
                 if isinstance(insn.src, binja.HighLevelILImport) and str(insn.src) == '__NSConcreteStackBlock':
                     isa = insn.src.address
+                    got |= 1 << 0
             elif insn.dest.member_index == 1:
                 if isinstance(insn.src, binja.HighLevelILStructField):
                     raise RuntimeError("RHS of flags is struct field instead of constant.  If d8-d15/v8-v15 then likely because of Binja bug treating them as caller-saved when they are supposed to be callee-saved.")
                 if isinstance(insn.src, (binja.HighLevelILConst,
                                          binja.HighLevelILConstPtr)):
                     flags = insn.src.constant
+                    got |= 1 << 1
             elif insn.dest.member_index == 2:
                 if isinstance(insn.src, (binja.HighLevelILConst,
                                          binja.HighLevelILConstPtr)):
                     reserved = insn.src.constant
                 else:
                     reserved = None
+                got |= 1 << 2
             elif insn.dest.member_index == 3:
                 if isinstance(insn.src, (binja.HighLevelILConst,
                                          binja.HighLevelILConstPtr)):
                     invoke = insn.src.constant
+                    got |= 1 << 3
             elif insn.dest.member_index == 4:
                 if isinstance(insn.src, (binja.HighLevelILConst,
                                          binja.HighLevelILConstPtr)):
                     descriptor = insn.src.constant
+                    got |= 1 << 4
             else:
                 # We don't know if the members are assigned in-order,
                 # so we cannot rely on having descriptor and hence
@@ -329,8 +653,7 @@ class BlockLiteral:
                 # up imported variables here.  We'll need another pass
                 # for that later.
                 pass
-            local_vars = locals()
-            if all([vn in local_vars for vn in ('isa', 'flags', 'reserved', 'invoke', 'descriptor')]):
+            if got == 0b11111:
                 break
         return cls(bv, is_stack_block, bl_insn, isa, flags, reserved, invoke, descriptor)
 
@@ -368,22 +691,49 @@ class BlockLiteral:
         """
         Annotate the block literal.
         """
-        # Packed because block layout bytecode can lead to misaligned words,
-        # which according to comments in LLVM source code seems intentional.
-        struct = binja.StructureBuilder.create(packed=True)
-        struct.append(_get_objc_type(self._bv, "Class"), "isa")
-        struct.append(self._bv.parse_type_string(f"volatile uint32_t flags")[0], "flags")
-        struct.append(self._bv.parse_type_string(f"uint32_t reserved")[0], "reserved")
-        struct.append(_get_libclosure_type(self._bv, "BlockInvokeFunction"), "invoke")
-        struct.append(binja.Type.pointer(self._bv.arch, _get_libclosure_type(self._bv, "Block_descriptor_1")), "descriptor") # placeholder
-        if bd.imported_variables_size > 0:
+        # Multiple literals typically share one descriptor and with it an
+        # identical layout.  Build and register the literal struct only once
+        # per descriptor and reuse it for all literals referring to it; the
+        # struct is keyed and named by the descriptor, not the literal.
+        cache = getattr(self._bv, '_block_layout_cache', None)
+        if cache is None:
+            cache = self._bv._block_layout_cache = {}
+        cache_key = (bd.address,
+                     getattr(bd, 'layout', 0),
+                     bd.block_flags & (BLOCK_HAS_EXTENDED_LAYOUT | BLOCK_HAS_SIGNATURE))
+        with _TYPE_TABLE_LOCK:
+            cached = cache.get(cache_key)
+        if cached is not None:
+            self.struct_builder, self.struct_name, byref_indexes, layout_end = cached
+            self.byref_indexes = list(byref_indexes)
+            if layout_end is not None:
+                bd.layout_end = layout_end
+        else:
+            # Packed because block layout bytecode can lead to misaligned words,
+            # which according to comments in LLVM source code seems intentional.
+            prims = _get_prim_types(self._bv)
+            struct = binja.StructureBuilder.create(packed=True)
+            struct.append(_get_objc_type(self._bv, "Class"), "isa")
+            struct.append(prims['volatile uint32_t'], "flags")
+            struct.append(prims['uint32_t'], "reserved")
+            struct.append(_get_libclosure_type(self._bv, "BlockInvokeFunction"), "invoke")
+            struct.append(binja.Type.pointer(self._bv.arch, _get_libclosure_type(self._bv, "Block_descriptor_1")), "descriptor") # placeholder
             self.byref_indexes = []
-            append_layout_fields(self._bv, struct, bd.layout, bd.block_has_extended_layout, self.byref_indexes, layout_end_obj=bd)
-        self.struct_builder = struct
-        self.struct_name = f"Block_literal_{self.address:x}"
-        self._bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, self.struct_name), self.struct_name, self.struct_builder)
+            if bd.imported_variables_size > 0:
+                append_layout_fields(self._bv, struct, bd.layout, bd.block_has_extended_layout, self.byref_indexes, layout_end_obj=bd)
+            self.struct_builder = struct
+            self.struct_name = f"Block_layout_{bd.address:x}"
+            with _TYPE_TABLE_LOCK:
+                _define_struct(self._bv, self.struct_name, self.struct_builder)
+                cache[cache_key] = (self.struct_builder, self.struct_name,
+                                    tuple(self.byref_indexes), getattr(bd, 'layout_end', None))
+        # The header fields are appended in fixed order, so the member
+        # indexes of the invoke and descriptor pointers are known without
+        # scanning the struct.
+        self._invoke_index = 3
+        self._descriptor_index = 4
         self.struct_type_name = f"struct {self.struct_name}"
-        self.struct_type = self._bv.parse_type_string(self.struct_type_name)[0]
+        self.struct_type = _resolve_struct_type(self._bv, self.struct_name)
         assert self.struct_type is not None
         if self.is_stack_block:
             if isinstance(self.insn, binja.HighLevelILVarDeclare):
@@ -395,8 +745,14 @@ class BlockLiteral:
                     raise RuntimeError(f"self.insn.dest is unexpected type {type(self.insn.dest).__name__}")
             else:
                 raise RuntimeError(f"self.insn is unexpected type {type(self.insn).__name__}")
-            stack_var_type_name = str(stack_var.type)
-            if stack_var_type_name.startswith("struct Block_literal_") and stack_var_type_name != self.struct_type_name:
+            # Prefer the registered name over stringifying the whole
+            # type, which walks and renders the full struct.
+            registered_name = getattr(stack_var.type, 'registered_name', None)
+            if registered_name is not None:
+                stack_var_type_name = f"struct {registered_name.name}"
+            else:
+                stack_var_type_name = str(stack_var.type)
+            if stack_var_type_name.startswith("struct Block_layout_") and stack_var_type_name != self.struct_type_name:
                 # Stack var has already been annotated for initialization code
                 # at a different address, likely because multiple branches in
                 # the function place a block at the same stack address.
@@ -417,11 +773,15 @@ class BlockLiteral:
         if self.struct_builder.width < bd.size:
             # The comment uses ###h instead of 0x### syntax to avoid Binja
             # interpreting hexadecimal sizes as clickable addresses.
-            n_unaccounted = bd.size - struct.width
+            n_unaccounted = bd.size - self.struct_builder.width
             self._bv.set_comment_at(self.address, f"Apple Blocks Plugin:\nBlock literal nominal size {bd.size:x}h.\n{self.struct_type_name} has width {self.struct_builder.width:x}h.\n{n_unaccounted:x}h bytes missing, add to struct manually.")
             # XXX try to pick up imported vars automatically
 
     def _type_for_ctype(self, ctype):
+        cache_key = (id(self._bv), ctype)
+        type_ = _CTYPE_CACHE.get(cache_key)
+        if type_ is not None:
+            return type_
         if ctype.endswith("!"):
             fallback = 'id'
             ctype = ctype.replace("!", "*")
@@ -430,17 +790,28 @@ class BlockLiteral:
         else:
             fallback = 'void'
         try:
-            return self._bv.parse_type_string(ctype)[0]
+            type_ = self._bv.parse_type_string(ctype)[0]
         except SyntaxError:
             # XXX if struct or union and we have member type info, create struct or union and retry
-            return self._bv.parse_type_string(fallback)[0]
+            # The fallbacks never change; no need to go through the parser.
+            if fallback == 'id':
+                type_ = _get_objc_type(self._bv, 'id')
+            elif fallback == 'void *':
+                type_ = _get_prim_types(self._bv)['void *']
+            else:
+                type_ = binja.Type.void()
+        _CTYPE_CACHE[cache_key] = type_
+        return type_
 
     def annotate_layout_bytecode(self, bd):
+        if bd.imported_variables_size == 0:
+            # No captured variables, no layout to annotate.
+            return
         if bd.block_has_signature and bd.block_has_extended_layout and bd.layout >= 0x1000:
             n = bd.layout_end - bd.layout
             shinobi.make_data_var(self._bv,
                                   bd.layout,
-                                  self._bv.parse_type_string(f"uint8_t [{n}]")[0],
+                                  binja.Type.array(_get_prim_types(self._bv)['uint8_t'], n),
                                   f"block_layout_{bd.layout:x}")
 
     def annotate_functions(self, bd):
@@ -460,7 +831,7 @@ class BlockLiteral:
                 # be lost, which for structs by value determines if they
                 # get passed in multiple registers or on the stack).
                 try:
-                    ctypes = objctypes.ObjCEncodedTypes(bd.signature_raw).ctypes
+                    ctypes = _parse_signature(bd.signature_raw)
                     assert len(ctypes) > 0
                     types = list(map(self._type_for_ctype, ctypes))
                     types[1] = binja.Type.pointer(self._bv.arch, self.struct_type)
@@ -482,7 +853,7 @@ class BlockLiteral:
                 # types, leaving the other parameters undisturbed.
                 invoke_func.return_type = binja.Type.void()
                 invoke_func.parameter_vars[0].set_name_and_type_async("block", binja.Type.pointer(self._bv.arch, self.struct_type))
-                self._bv.update_analysis_and_wait()
+                _request_analysis_sync(self._bv)
 
             else:
                 # Set function type.
@@ -492,27 +863,25 @@ class BlockLiteral:
                 # Variable.type setters that do.  Also, the setter for
                 # Variable.name is not atomic; it will first copy the current
                 # type, then proceed to set both name and type on the variable.
-                # As a result, we need to update_analysis_and_wait() manually
-                # to avoid an easy-to-repro race condition where a subsequent
-                # assignment to Variable.name while the Function.type
-                # assignment is still in flight may clobber the type for the
-                # first parameter with the type it had before assigning the
-                # function type.
-                invoke_func.type = func_type
-                self._bv.update_analysis_and_wait()
-
+                # An assignment to Variable.name while the Function.type
+                # assignment is still in flight may therefore clobber the type
+                # for the first parameter with the type it had before
+                # assigning the function type.  Set name and type atomically
+                # via set_name_and_type_async() before assigning the function
+                # type, which makes an analysis sync in between unnecessary.
                 if len(invoke_func.parameter_vars) >= 1:
-                    invoke_func.parameter_vars[0].name = "block"
+                    invoke_func.parameter_vars[0].set_name_and_type_async("block", binja.Type.pointer(self._bv.arch, self.struct_type))
+                invoke_func.type = func_type
+                _request_analysis_sync(self._bv)
 
                 # propagate invoke function signature to invoke pointer on block literal
-                invoke_pointer_index = self.struct_builder.index_by_name("invoke")
-                self.struct_builder.replace(invoke_pointer_index,
-                                            binja.Type.pointer(self._bv.arch, func_type), "invoke")
-                self._bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, self.struct_name),
-                                     self.struct_name, self.struct_builder)
-                self.struct_type = self._bv.parse_type_string(self.struct_type_name)[0]
-
-            if invoke_func.name == f"sub_{invoke_func.start:x}":
+                with _TYPE_TABLE_LOCK:
+                    self.struct_builder.replace(self._invoke_index,
+                                                binja.Type.pointer(self._bv.arch, func_type), "invoke")
+                    _define_struct(self._bv, self.struct_name, self.struct_builder)
+                    self.struct_type = _resolve_struct_type(self._bv, self.struct_name)
+
+            if _has_auto_name(invoke_func):
                 invoke_func.name = f"sub_{invoke_func.start:x}_block_invoke"
 
         if bd.block_has_copy_dispose:
@@ -535,18 +904,25 @@ class BlockLiteral:
                 if dispose_func is not None:
                     if len(dispose_func.parameter_vars) >= 1:
                         dispose_func.parameter_vars[0].set_name_async("dst")
-                self._bv.update_analysis_and_wait()
+                _request_analysis_sync(self._bv)
 
                 if copy_func is not None:
-                    if copy_func.name == f"sub_{copy_func.start:x}":
+                    if _has_auto_name(copy_func):
                         copy_func.name = f"sub_{copy_func.start:x}_block_copy"
 
                 if dispose_func is not None:
-                    if dispose_func.name == f"sub_{dispose_func.start:x}":
+                    if _has_auto_name(dispose_func):
                         dispose_func.name = f"sub_{dispose_func.start:x}_block_dispose"
 
 
 class BlockDescriptor:
+    __slots__ = (
+        "_bv", "address", "block_flags", "reserved", "size",
+        "copy", "dispose", "signature", "signature_raw",
+        "layout", "layout_end", "struct_builder", "struct_name",
+        "struct_type_name", "struct_type",
+    )
+
     def __init__(self, bv, descriptor_address, block_flags):
         """
         Read block descriptor from data.
@@ -555,24 +931,43 @@ class BlockDescriptor:
         self.address = descriptor_address
         self.block_flags = block_flags
 
-        br = binja.BinaryReader(self._bv)
-        br.seek(self.address)
-        self.reserved = br.read64()
-        self.size = br.read64()
+        # Read all present descriptor fields in one go; all targets are
+        # little-endian.
+        n_fields = 2
+        if self.block_has_copy_dispose:
+            n_fields += 2
+        if self.block_has_signature:
+            n_fields += 2
+        buf = self._bv.read(self.address, 8 * n_fields)
+        fields = structmod.unpack_from(f"<{n_fields}Q", buf)
+        self.reserved = fields[0]
+        self.size = fields[1]
         assert self.size >= 0x20
+        next_field = 2
         if self.block_has_copy_dispose:
-            self.copy = br.read64()
-            self.dispose = br.read64()
+            self.copy = fields[next_field]
+            self.dispose = fields[next_field + 1]
+            next_field += 2
         else:
             self.copy = None
             self.dispose = None
         if self.block_has_signature:
-            self.signature = br.read64()
+            self.signature = fields[next_field]
             if self.signature != 0:
-                self.signature_raw = self._bv.get_ascii_string_at(self.signature, 0).raw
+                # Descriptors referenced by many literals and descriptors
+                # sharing a signature pointer would otherwise re-read the
+                # same string over and over.
+                sig_cache = getattr(self._bv, '_block_sig_cache', None)
+                if sig_cache is None:
+                    sig_cache = self._bv._block_sig_cache = {}
+                signature_raw = sig_cache.get(self.signature)
+                if signature_raw is None:
+                    signature_raw = self._bv.get_ascii_string_at(self.signature, 0).raw
+                    sig_cache[self.signature] = signature_raw
+                self.signature_raw = signature_raw
             else:
                 self.signature_raw = None
-            self.layout = br.read64()
+            self.layout = fields[next_field + 1]
 
     @property
     def imported_variables_size(self):
@@ -602,27 +997,28 @@ class BlockDescriptor:
         """
         Annotate block descriptor.
         """
+        prims = _get_prim_types(self._bv)
         struct = binja.StructureBuilder.create()
-        struct.append(self._bv.parse_type_string("uint64_t reserved")[0], "reserved")
-        struct.append(self._bv.parse_type_string("uint64_t size")[0], "size")
+        struct.append(prims['uint64_t'], "reserved")
+        struct.append(prims['uint64_t'], "size")
         if self.block_has_copy_dispose:
             struct.append(_get_libclosure_type(self._bv, "BlockCopyFunction"), "copy")
             struct.append(_get_libclosure_type(self._bv, "BlockDisposeFunction"), "dispose")
         if self.block_has_signature:
-            struct.append(self._bv.parse_type_string("char const *signature")[0], "signature")
-            if self.layout != 0 and self.block_has_extended_layout:
+            struct.append(prims['char const *'], "signature")
+            if self.imported_variables_size > 0 and self.layout != 0 and self.block_has_extended_layout:
                 if self.layout < 0x1000:
-                    struct.append(self._bv.parse_type_string("uint64_t layout")[0], "layout")
+                    struct.append(prims['uint64_t'], "layout")
                 else:
-                    struct.append(self._bv.parse_type_string("uint8_t const *layout")[0], "layout")
+                    struct.append(prims['uint8_t const *'], "layout")
             else:
                 # XXX non-extended layout or layout 0
-                struct.append(self._bv.parse_type_string("void *layout")[0], "layout")
+                struct.append(prims['void *'], "layout")
         self.struct_builder = struct
         self.struct_name = f"Block_descriptor_{self.address:x}"
-        self._bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, self.struct_name), self.struct_name, self.struct_builder)
+        _define_struct(self._bv, self.struct_name, self.struct_builder)
         self.struct_type_name = f"struct {self.struct_name}"
-        self.struct_type = self._bv.parse_type_string(self.struct_type_name)[0]
+        self.struct_type = _resolve_struct_type(self._bv, self.struct_name)
         assert self.struct_type is not None
         shinobi.make_data_var(self._bv,
                               self.address,
@@ -630,18 +1026,23 @@ class BlockDescriptor:
                               f"block_descriptor_{self.address:x}")
 
         # propagate struct type to descriptor pointer on block literal
-        pointer_index = bl.struct_builder.index_by_name("descriptor")
-        bl.struct_builder.replace(pointer_index, binja.Type.pointer(self._bv.arch, self.struct_type), "descriptor")
-        self._bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, bl.struct_name), bl.struct_name, bl.struct_builder)
-        bl.struct_type = self._bv.parse_type_string(bl.struct_type_name)[0]
+        with _TYPE_TABLE_LOCK:
+            bl.struct_builder.replace(bl._descriptor_index, binja.Type.pointer(self._bv.arch, self.struct_type), "descriptor")
+            _define_struct(self._bv, bl.struct_name, bl.struct_builder)
+            bl.struct_type = _resolve_struct_type(self._bv, bl.struct_name)
 
 
-def annotate_global_block_literal(bv, block_literal_addr):
+def annotate_global_block_literal(bv, block_literal_addr, ext_sym=None, force=False):
     where = f"global block {block_literal_addr:x}"
 
+    block_literal_data_var = bv.get_data_var_at(block_literal_addr)
+    if not force and block_literal_data_var is not None \
+            and block_literal_data_var.name == f"global_block_{block_literal_addr:x}":
+        print(f"Skipping already annotated {where}")
+        return
+
     print(f"Annotating {where}")
 
-    block_literal_data_var = bv.get_data_var_at(block_literal_addr)
     if block_literal_data_var is None:
         # We only expect this to happen for manual invocation, not
         # for the automatic sweep, as the sweep requires data
@@ -657,7 +1058,8 @@ def annotate_global_block_literal(bv, block_literal_addr):
     if not isinstance(data_var_value, int):
         print(f"{where}: Data var has value {data_var_value} of type {type(data_var_value).__name__}, expected int, fix plugin", file=sys.stderr)
         return
-    ext_sym = shinobi.get_symbol_of_type(bv, "__NSConcreteGlobalBlock", binja.SymbolType.ExternalSymbol)
+    if ext_sym is None:
+        ext_sym = _get_symbol_of_type(bv, "__NSConcreteGlobalBlock", binja.SymbolType.ExternalSymbol)
     if ext_sym is None:
         print(f"__NSConcreteGlobalBlock not found", file=sys.stderr)
         return
@@ -675,15 +1077,13 @@ def annotate_global_block_literal(bv, block_literal_addr):
         bl.annotate_layout_bytecode(bd)
         bl.annotate_functions(bd)
     except Exception as e:
-        print(f"{where}: {type(e).__name__}: {e}\n{traceback.format_exc()}", file=sys.stderr)
+        print(f"{where}: {type(e).__name__}: {e}{_exc_detail()}", file=sys.stderr)
         return
 
 
-def annotate_stack_block_literal(bv, block_literal_insn):
+def annotate_stack_block_literal(bv, block_literal_insn, force=False):
     where = f"stack block {block_literal_insn.address:x}"
 
-    print(f"Annotating {where}")
-
     if isinstance(block_literal_insn, binja.HighLevelILVarInit):
         # The most common case where Binja knows nothing about the stack
         # variable.  The initialization with __NSConcreteStackBlock is a
@@ -707,6 +1107,12 @@ def annotate_stack_block_literal(bv, block_literal_insn):
         print(f"{where}: Instruction is neither a var init nor an assign", file=sys.stderr)
         return
 
+    if not force and block_literal_var.name.startswith("stack_block_"):
+        print(f"Skipping already annotated {where}")
+        return
+
+    print(f"Annotating {where}")
+
     if block_literal_var.source_type != binja.VariableSourceType.StackVariableSourceType:
         print(f"{where}: Assignment is not to a stack variable (var source_type is {block_literal_var.source_type!r})", file=sys.stderr)
         return
@@ -725,7 +1131,7 @@ def annotate_stack_block_literal(bv, block_literal_insn):
         bl.annotate_layout_bytecode(bd)
         bl.annotate_functions(bd)
     except Exception as e:
-        print(f"{where}: {type(e).__name__}: {e}\n{traceback.format_exc()}", file=sys.stderr)
+        print(f"{where}: {type(e).__name__}: {e}{_exc_detail()}", file=sys.stderr)
         return
 
     # XXX refactor byref handling
@@ -736,20 +1142,19 @@ def annotate_stack_block_literal(bv, block_literal_insn):
         if bd.imported_variables_size > 0 and len(bl.byref_indexes) > 0:
             byref_srcs = []
             byref_indexes_set = set(bl.byref_indexes)
-            for insn in shinobi.yield_struct_field_assign_hlil_instructions_for_var_id(bl.insn.function, bl.insn.var.identifier):
-                if isinstance(insn.src, binja.HighLevelILAddressOf):
+            # Index the function's HLIL in a single pass up front; the
+            # previous per-byref scans made this section O(instructions
+            # times byrefs).
+            decls_by_var_id, field_assigns_by_var_id = shinobi.index_function_hlil(bl.insn.function)
+            # The var table is much smaller than the instruction list;
+            # use it to look up the byref variables themselves and keep
+            # the declaration index only as a reload anchor.
+            vars_by_id = {v.identifier: v for v in bl.insn.function.vars}
+            for insn in field_assigns_by_var_id.get(bl.insn.var.identifier, ()):
+                src_type = type(insn.src)
+                if src_type is _BYREF_SRC_ADDROF:
                     insn_src = insn.src
-                elif isinstance(insn.src, (binja.HighLevelILDerefField,
-                                           binja.HighLevelILDeref,
-                                           binja.HighLevelILImport,
-                                           binja.HighLevelILConst,
-                                           binja.HighLevelILConstPtr,
-                                           binja.HighLevelILCall,
-                                           binja.HighLevelILStructField,
-                                           binja.HighLevelILVar)):
-                    # binja.HighLevelILStructField is typically because of Binja bug
-                    # treating d8-15/v8-15 as caller-saved instead of callee-saved.
-                    # binja.HighLevelILVar is typically a byref passed as argument.
+                elif src_type in _BYREF_SRC_SKIP:
                     insn_src = None
                 else:
                     print(f"{where}: Skipping assignment right-hand-side for {insn.src!r}, fix plugin", file=sys.stderr)
@@ -768,23 +1173,12 @@ def annotate_stack_block_literal(bv, block_literal_insn):
                     print(f"{where}: Byref src var {byref_src} src is {type(byref_src.src).__name__}: Annotate manually", file=sys.stderr)
                     continue
 
-                byref_insn = None
-                for insn in bl.insn.function.instructions:
-                    if isinstance(insn, binja.HighLevelILVarDeclare):
-                        cand_var = insn.var
-                    elif isinstance(insn, binja.HighLevelILVarInit):
-                        if isinstance(insn.dest, binja.HighLevelILStructField):
-                            continue
-                        cand_var = insn.dest
-                    else:
-                        continue
-
-                    if cand_var.identifier == var_id:
-                        byref_insn = insn
-                        byref_insn_var = cand_var
-                        break
-
-                else:
+                byref_insn_var = vars_by_id.get(var_id)
+                if byref_insn_var is None:
+                    print(f"{where}: Byref src var {byref_src} id {var_id:x} not found in function's var table", file=sys.stderr)
+                    continue
+                byref_insn = decls_by_var_id.get(var_id)
+                if byref_insn is None:
                     print(f"{where}: Byref src var {byref_src} id {var_id:x} not found in function's var declarations and inits", file=sys.stderr)
                     continue
 
@@ -793,83 +1187,105 @@ def annotate_stack_block_literal(bv, block_literal_insn):
 
                 byref_insn_var.name = f"block_byref_{byref_insn_var.name}"
 
-                byref_struct = binja.StructureBuilder.create()
-                byref_struct.append(_get_objc_type(bv, "Class"), "isa")
-                byref_struct.append(bv.parse_type_string("void *forwarding")[0], "forwarding") # placeholder
-                byref_struct.append(bv.parse_type_string("volatile int32_t flags")[0], "flags")
-                byref_struct.append(bv.parse_type_string("uint32_t size")[0], "size")
-
-                byref_insn_var.type = byref_struct
+                # Apply a speculative worst-case byref header type so that
+                # a single reload surfaces all the header assignments at
+                # once; reloading the function's HLIL is by far the most
+                # expensive operation in this loop.  For byrefs without
+                # copy/dispose helpers the word at the byref_keep slot
+                # (offset 0x18) is really the extended layout; flags tells
+                # us which interpretation applies, from the same pass.
+                probe_struct = shinobi.build_struct((
+                    (_get_objc_type(bv, "Class"), "isa"),
+                    (_parsed_type(bv, "void *forwarding"), "forwarding"),
+                    (_parsed_type(bv, "volatile int32_t flags"), "flags"),
+                    (_parsed_type(bv, "uint32_t size"), "size"),
+                    (_get_libclosure_type(bv, "BlockByrefKeepFunction"), "byref_keep"),
+                    (_get_libclosure_type(bv, "BlockByrefDestroyFunction"), "byref_destroy"),
+                    (_parsed_type(bv, "void *layout"), "layout"),
+                ))
+
+                byref_insn_var.type = probe_struct
                 byref_insn = shinobi.reload_hlil_instruction(bv, byref_insn)
                 byref_insn_var = byref_insn.var
 
-                for insn in shinobi.yield_struct_field_assign_hlil_instructions_for_var_id(byref_insn.function, byref_insn_var.identifier):
-                    # 0 isa
-                    # 1 forwarding
-                    if insn.dest.member_index == 2:
-                        if isinstance(insn.src, (binja.HighLevelILConst,
-                                                 binja.HighLevelILConstPtr)):
-                            byref_flags = insn.src.constant
-                    elif insn.dest.member_index == 3:
-                        if isinstance(insn.src, (binja.HighLevelILConst,
-                                                 binja.HighLevelILConstPtr)):
-                            byref_size = insn.src.constant
-                try:
-                    print(f"Block byref at {byref_insn.address:x} flags {byref_flags:08x} size {byref_size:#x}")
-                except UnboundLocalError as e:
+                # Identifiers may have changed across the reload;
+                # re-index the reloaded function.
+                _, byref_field_assigns = shinobi.index_function_hlil(byref_insn.function)
+                byref_consts = {}
+                for insn in byref_field_assigns.get(byref_insn_var.identifier, ()):
+                    if isinstance(insn.src, (binja.HighLevelILConst,
+                                             binja.HighLevelILConstPtr)):
+                        byref_consts.setdefault(insn.dest.member_index, insn.src.constant)
+                # 0 isa
+                # 1 forwarding
+                byref_flags = byref_consts.get(2)
+                byref_size = byref_consts.get(3)
+                if byref_flags is None or byref_size is None:
                     print(f"Block byref at {byref_insn.address:x} failed to find flags or size assignments", file=sys.stderr)
                     continue
-
+                print(f"Block byref at {byref_insn.address:x} flags {byref_flags:08x} size {byref_size:#x}")
+
+                byref_members = [
+                    (_get_objc_type(bv, "Class"), "isa"),
+                    (_parsed_type(bv, "void *forwarding"), "forwarding"), # placeholder
+                    (_parsed_type(bv, "volatile int32_t flags"), "flags"),
+                    (_parsed_type(bv, "uint32_t size"), "size"),
+                ]
                 if (byref_flags & BLOCK_BYREF_HAS_COPY_DISPOSE) != 0:
-                    byref_struct.append(_get_libclosure_type(bv, "BlockByrefKeepFunction"), "byref_keep")
-                    byref_struct.append(_get_libclosure_type(bv, "BlockByrefDestroyFunction"), "byref_destroy")
+                    byref_members.append((_get_libclosure_type(bv, "BlockByrefKeepFunction"), "byref_keep"))
+                    byref_members.append((_get_libclosure_type(bv, "BlockByrefDestroyFunction"), "byref_destroy"))
+                    # layout is the probe struct's layout member
+                    byref_layout_member_index = 6
+                else:
+                    # layout is the probe struct's byref_keep member
+                    byref_layout_member_index = 4
+                byref_layout = None
                 byref_layout_nibble = (byref_flags & BLOCK_BYREF_LAYOUT_MASK)
                 if byref_layout_nibble == BLOCK_BYREF_LAYOUT_EXTENDED:
-                    byref_struct.append(bv.parse_type_string("void *layout")[0], "layout")
-                    layout_index = byref_struct.index_by_name("layout")
-                    byref_insn_var.type = byref_struct
-                    byref_insn = shinobi.reload_hlil_instruction(bv, byref_insn)
-                    byref_insn_var = byref_insn.var
-                    for insn in shinobi.yield_struct_field_assign_hlil_instructions_for_var_id(byref_insn.function, byref_insn_var.identifier):
-                        if insn.dest.member_index == layout_index:
-                            assert isinstance(insn.src, (binja.HighLevelILConst,
-                                                         binja.HighLevelILConstPtr))
-                            byref_layout = insn.src.constant
-                            break
-                    if byref_layout != 0:
-                        if byref_layout < 0x1000:
-                            byref_struct.replace(layout_index, bv.parse_type_string("uint64_t layout")[0], "layout")
-                        else:
-                            byref_struct.replace(layout_index, bv.parse_type_string("uint8_t const *layout")[0], "layout")
-                    append_layout_fields(bv, byref_struct, byref_layout, block_has_extended_layout=True)
+                    byref_layout = byref_consts.get(byref_layout_member_index)
+                    if byref_layout is None:
+                        print(f"Block byref at {byref_insn.address:x} failed to find layout assignment", file=sys.stderr)
+                        continue
+                    if byref_layout == 0:
+                        byref_members.append((_parsed_type(bv, "void *layout"), "layout"))
+                    elif byref_layout < 0x1000:
+                        byref_members.append((_parsed_type(bv, "uint64_t layout"), "layout"))
+                    else:
+                        byref_members.append((_parsed_type(bv, "uint8_t const *layout"), "layout"))
                 elif byref_layout_nibble == BLOCK_BYREF_LAYOUT_NON_OBJECT:
-                    byref_struct.append(bv.parse_type_string("uint64_t non_object_0")[0], "non_object_0")
+                    byref_members.append((_parsed_type(bv, "uint64_t non_object_0"), "non_object_0"))
                 elif byref_layout_nibble == BLOCK_BYREF_LAYOUT_STRONG:
-                    byref_struct.append(_get_objc_type(bv, "id"), "strong_ptr_0")
+                    byref_members.append((_get_objc_type(bv, "id"), "strong_ptr_0"))
                 elif byref_layout_nibble == BLOCK_BYREF_LAYOUT_WEAK:
-                    byref_struct.append(_get_objc_type(bv, "id"), "weak_ptr_0")
+                    byref_members.append((_get_objc_type(bv, "id"), "weak_ptr_0"))
                 elif byref_layout_nibble == BLOCK_BYREF_LAYOUT_UNRETAINED:
-                    byref_struct.append(_get_objc_type(bv, "id"), "unretained_ptr_0")
+                    byref_members.append((_get_objc_type(bv, "id"), "unretained_ptr_0"))
+
+                byref_struct = shinobi.build_struct(byref_members)
+                if byref_layout_nibble == BLOCK_BYREF_LAYOUT_EXTENDED:
+                    append_layout_fields(bv, byref_struct, byref_layout, block_has_extended_layout=True)
 
                 byref_struct_name = f"Block_byref_{byref_insn.address:x}"
-                bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, byref_struct_name), byref_struct_name, byref_struct)
-                byref_struct_type_name = f"struct {byref_struct_name}"
-                byref_struct_type = bv.parse_type_string(byref_struct_type_name)[0]
-                assert byref_struct_type is not None
 
-                # propagate registered struct to forwarding self pointer
-                byref_struct.replace(1, binja.Type.pointer(bv.arch, byref_struct_type), "forwarding")
-                bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, byref_struct_name), byref_struct_name, byref_struct)
-                byref_struct_type = bv.parse_type_string(byref_struct_type_name)[0]
+                # patch the forwarding self pointer with a named reference
+                # before the one and only define; the reference resolves
+                # once the struct is registered under that name
+                byref_struct_ref = binja.Type.named_type_reference(binja.NamedTypeReferenceClass.StructNamedTypeClass, byref_struct_name)
+                byref_struct.replace(1, binja.Type.pointer(bv.arch, byref_struct_ref), "forwarding")
+                with _TYPE_TABLE_LOCK:
+                    bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, byref_struct_name), byref_struct_name, byref_struct)
+                byref_struct_type = binja.Type.named_type_from_registered_type(bv, byref_struct_name)
+                assert byref_struct_type is not None
 
                 byref_insn_var.type = byref_struct_type
 
                 # propagate byref type to block literal type
-                byref_member_name = bl.struct_builder.members[byref_member_index].name
-                assert byref_member_name.startswith("byref_ptr_")
-                bl.struct_builder.replace(byref_member_index, binja.Type.pointer(bv.arch, byref_struct_type), byref_member_name)
-                bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, bl.struct_name), bl.struct_name, bl.struct_builder)
-                bl.struct_type = bv.parse_type_string(bl.struct_type_name)[0]
+                with _TYPE_TABLE_LOCK:
+                    byref_member_name = bl.struct_builder.members[byref_member_index].name
+                    assert byref_member_name.startswith("byref_ptr_")
+                    bl.struct_builder.replace(byref_member_index, binja.Type.pointer(bv.arch, byref_struct_type), byref_member_name)
+                    bv.define_type(binja.Type.generate_auto_type_id(_TYPE_ID_SOURCE, bl.struct_name), bl.struct_name, bl.struct_builder)
+                    bl.struct_type = bv.parse_type_string(bl.struct_type_name)[0]
 
                 # XXX annotate functions, which is often hard with the use of
                 # callee-saved D/V registers treated as caller-saved in HLIL;
@@ -877,47 +1293,82 @@ def annotate_stack_block_literal(bv, block_literal_insn):
                 # D8-15 are callee-saved but the rest of V8-15 are caller-saved.
 
     except Exception as e:
-        print(f"{where}: {type(e).__name__}: {e}\n{traceback.format_exc()}", file=sys.stderr)
+        print(f"{where}: {type(e).__name__}: {e}{_exc_detail()}", file=sys.stderr)
         return
 
 
-def annotate_all_global_blocks(bv, set_progress=None):
-    ext_sym = shinobi.get_symbol_of_type(bv, "__NSConcreteGlobalBlock", binja.SymbolType.ExternalSymbol)
+def annotate_all_global_blocks(bv, set_progress=None, force=False):
+    ext_sym = _get_symbol_of_type(bv, "__NSConcreteGlobalBlock", binja.SymbolType.ExternalSymbol)
     if ext_sym is None:
         print("__NSConcreteGlobalBlock not found, target does not appear to contain any global blocks")
         return
     assert ext_sym.address is not None and ext_sym.address != 0
-    for addr in bv.get_data_refs(ext_sym.address):
-        if set_progress is not None:
-            set_progress(f"{addr:x}")
-        annotate_global_block_literal(bv, addr)
-
-
-def annotate_all_stack_blocks(bv, set_progress=None):
-    imp_data_sym = shinobi.get_symbol_of_type(bv, "__NSConcreteStackBlock", binja.SymbolType.ImportedDataSymbol)
-    imp_addr_sym = shinobi.get_symbol_of_type(bv, "__NSConcreteStackBlock", binja.SymbolType.ImportAddressSymbol)
+    addrs = list(bv.get_data_refs(ext_sym.address))
+    with _block_sweep(bv):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(annotate_global_block_literal, bv, addr, ext_sym=ext_sym, force=force): addr
+                       for addr in addrs}
+            for future in concurrent.futures.as_completed(futures):
+                if set_progress is not None:
+                    set_progress(f"{futures[future]:x}")
+                future.result()
+
+
+def annotate_all_stack_blocks(bv, set_progress=None, force=False):
+    imp_data_sym = _get_symbol_of_type(bv, "__NSConcreteStackBlock", binja.SymbolType.ImportedDataSymbol)
+    imp_addr_sym = _get_symbol_of_type(bv, "__NSConcreteStackBlock", binja.SymbolType.ImportAddressSymbol)
     imp_sym = imp_data_sym or imp_addr_sym or None
     if imp_sym is None:
         print("__NSConcreteStackBlock not found, target does not appear to contain any stack blocks")
         return
-    # We'd want to use get_code_refs here, but it is very unreliable.
-    # Yielded refsrc objects often have only llil but not mlil or hlil;
-    # .llil.hlil is also None, .llil.hlils contains the llil that matches,
-    # sometimes multiple times.  The issue seems more frequent on but not
-    # limited to arm64.
-    #for refsrc in bv.get_code_refs(imp_sym.address):
-    #    print(refsrc)
-    #    print(refsrc.llil, refsrc.mlil, refsrc.hlil, refsrc.llil.hlil, refsrc.llil.hlils)
-    for insn in bv.hlil_instructions:
-        if not isinstance(insn, binja.HighLevelILVarInit):
-            continue
-        if not isinstance(insn.src, binja.HighLevelILImport):
-            continue
-        if insn.src.constant != imp_sym.address:
-            continue
-        if set_progress is not None:
-            set_progress(f"{insn.address:x}")
-        annotate_stack_block_literal(bv, insn)
+    # We'd want to map get_code_refs directly to HLIL here, but that is
+    # very unreliable.  Yielded refsrc objects often have only llil but
+    # not mlil or hlil; .llil.hlil is also None, .llil.hlils contains
+    # the llil that matches, sometimes multiple times.  The issue seems
+    # more frequent on but not limited to arm64.  The reference
+    # addresses themselves are usable, though: restrict the HLIL scan to
+    # the functions containing a reference instead of lifting every
+    # function in the binary.
+    candidate_funcs = {}
+    for refsrc in bv.get_code_refs(imp_sym.address):
+        for func in bv.get_functions_containing(refsrc.address):
+            candidate_funcs[func.start] = func
+    if len(candidate_funcs) > 0:
+        def _candidate_hlil_instructions():
+            for func in candidate_funcs.values():
+                yield from func.hlil.instructions
+        hlil_instructions = _candidate_hlil_instructions()
+    else:
+        # No code refs at all; fall back to scanning the whole binary.
+        hlil_instructions = bv.hlil_instructions
+    # Group matching instructions by containing function and annotate each
+    # function's blocks on one worker.  Annotating a stack block reloads the
+    # containing function's HLIL, so blocks within one function must be
+    # processed sequentially; blocks in different functions are independent.
+    insns_by_func = {}
+    # Hot loop over every candidate HLIL instruction; bind the classes
+    # and target address to locals and use exact type checks.
+    varinit_class = binja.HighLevelILVarInit
+    import_class = binja.HighLevelILImport
+    target_addr = imp_sym.address
+    for insn in hlil_instructions:
+        if type(insn) is varinit_class \
+                and type(insn.src) is import_class \
+                and insn.src.constant == target_addr:
+            insns_by_func.setdefault(insn.function.source_function.start, []).append(insn)
+
+    def _annotate_function_blocks(insns):
+        for insn in insns:
+            if set_progress is not None:
+                set_progress(f"{insn.address:x}")
+            annotate_stack_block_literal(bv, insn, force=force)
+
+    with _block_sweep(bv):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(_annotate_function_blocks, insns)
+                       for insns in insns_by_func.values()]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
 
 
 @shinobi.register_for_high_level_il_instruction("Blocks\\Annotate stack block here", is_valid=is_valid)
@@ -927,7 +1378,8 @@ def plugin_cmd_annotate_stack_block_literal_here(bv, block_literal_insn, set_pro
     """
     Define a stack block literal here.
     """
-    annotate_stack_block_literal(bv, block_literal_insn)
+    _clear_type_cache(bv)
+    annotate_stack_block_literal(bv, block_literal_insn, force=True)
 
 
 @shinobi.register_for_address("Blocks\\Annotate global block here", is_valid=is_valid)
@@ -937,7 +1389,8 @@ def plugin_cmd_annotate_global_block_literal_here(bv, address, set_progress=None
     """
     Define a global block literal here.
     """
-    annotate_global_block_literal(bv, address)
+    _clear_type_cache(bv)
+    annotate_global_block_literal(bv, address, force=True)
 
 
 @shinobi.register("Blocks\\Annotate all stack blocks", is_valid=is_valid)
@@ -948,6 +1401,7 @@ def plugin_cmd_annotate_all_stack_blocks(bv, set_progress=None):
     Look for all occurences of __NSConcreteStackBlock and
     annotate stack blocks where references are found.
     """
+    _clear_type_cache(bv)
     _define_ns_concrete_block_imports(bv)
     annotate_all_stack_blocks(bv, set_progress=set_progress)
 
@@ -960,6 +1414,7 @@ def plugin_cmd_annotate_all_global_blocks(bv, set_progress=None):
     Look for all occurences of __NSConcreteGlobalBlock and
     annotate global blocks where references are found.
     """
+    _clear_type_cache(bv)
     _define_ns_concrete_block_imports(bv)
     annotate_all_global_blocks(bv, set_progress=set_progress)
 
@@ -967,14 +1422,40 @@ def plugin_cmd_annotate_all_global_blocks(bv, set_progress=None):
 @shinobi.register("Blocks\\Annotate all blocks", is_valid=is_valid)
 @shinobi.background_task("Blocks: All blocks")
 @shinobi.undoable
-def plugin_cmd_annotate_all_stack_blocks(bv, set_progress=None):
+def plugin_cmd_annotate_all_blocks(bv, set_progress=None):
     """
     Look for all occurences of __NSConcreteGlobalBlock and __NSConcreteStackBlock
     and annotate all blocks where references are found.
+    Blocks that appear to have been annotated before are skipped.
+    """
+    _annotate_all_blocks(bv, set_progress=set_progress, force=False)
+
+
+@shinobi.register("Blocks\\Re-annotate all blocks", is_valid=is_valid)
+@shinobi.background_task("Blocks: All blocks")
+@shinobi.undoable
+def plugin_cmd_reannotate_all_blocks(bv, set_progress=None):
     """
+    Look for all occurences of __NSConcreteGlobalBlock and __NSConcreteStackBlock
+    and annotate all blocks where references are found, including blocks
+    that have been annotated before.
+    """
+    _annotate_all_blocks(bv, set_progress=set_progress, force=True)
+
+
+def _annotate_all_blocks(bv, set_progress=None, force=False):
+    _clear_type_cache(bv)
     _define_ns_concrete_block_imports(bv)
-    annotate_all_global_blocks(bv, set_progress=set_progress)
-    annotate_all_stack_blocks(bv, set_progress=set_progress)
+    with _block_sweep(bv):
+        # The global and stack traversals are independent; run them
+        # concurrently on the shared pool while the Task thread
+        # supervises.
+        executor = shinobi.shared_executor()
+        futures = [executor.submit(annotate_all_global_blocks, bv, set_progress=set_progress, force=force),
+                   executor.submit(annotate_all_stack_blocks, bv, set_progress=set_progress, force=force)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
 
 @shinobi.register_for_address("Blocks\\Remove plugin comment here", is_valid=is_valid)
 @shinobi.background_task("Blocks: Remove comment")
@@ -21,6 +21,27 @@
 
 import binaryninja as binja
 
+import concurrent.futures
+import os
+import threading
+
+
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+
+def shared_executor():
+    """
+    Return the shared bounded worker pool, creating it on first use.
+    Plugin commands use this to fan independent sub-tasks out across
+    cores instead of spawning a thread per task.
+    """
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+        return _shared_executor
+
 
 def register(label, *args, **kvargs):
     """
@@ -168,6 +189,19 @@ def make_data_var(bv, address, type_, name=None):
         data_var.type = type_
 
 
+def build_struct(members, packed=False):
+    """
+    Build a StructureBuilder from a sequence of (type, name) member
+    tuples.  Accumulating the members in Python first and appending
+    them in one tight loop keeps the builder calls together instead of
+    interleaving them with the logic choosing the members.
+    """
+    struct = binja.StructureBuilder.create(packed=packed)
+    for type_, name in members:
+        struct.append(type_, name)
+    return struct
+
+
 def reload_hlil_instruction(bv, hlil_insn):
     """
     Refresh the instruction and the function it is associated with.
@@ -190,36 +224,86 @@ def reload_hlil_instruction(bv, hlil_insn):
     return reloaded_insn
 
 
-def yield_struct_field_assign_hlil_instructions_for_var_id(hlil_func, var_id):
+# Handlers resolving the variable underneath a struct field assign
+# destination, dispatched on the exact HLIL class of the destination
+# source.  A single dict lookup replaces an isinstance cascade that ran
+# for every struct field assign of every indexed function.
+_DEST_SRC_HANDLERS = {
+    binja.HighLevelILVar:
+        lambda dest_src: dest_src.var,
+    binja.HighLevelILArrayIndex:
+        lambda dest_src: dest_src.src.var if isinstance(dest_src.src, binja.HighLevelILVar) else None,
+    binja.HighLevelILStructField:
+        lambda dest_src: dest_src.src.var if isinstance(dest_src.src, binja.HighLevelILVar) else None,
+    binja.HighLevelILDerefField:
+        lambda dest_src: None,
+}
+
+
+def _struct_field_assign_var(insn):
     """
-    Find all HLIL instructions that assign to struct fields of
-    a struct with a given variable identifier.
+    For an HLIL assign instruction with a struct field destination,
+    return the variable whose field is assigned, or None if the
+    destination does not resolve to a variable.
+    """
+    dest_src = insn.dest.src
+    handler = _DEST_SRC_HANDLERS.get(type(dest_src))
+    if handler is None:
+        raise NotImplementedError(f"Unhandled destination source type {type(dest_src).__name__} in assign insn {insn!r}, fix plugin")
+    return handler(dest_src)
 
-    Note that variable identifiers may change across type changes
-    in the function.
+
+def index_function_hlil(hlil_func, instructions=None):
+    """
+    Index a function's HLIL in a single pass.
+
+    Returns a tuple (decls_by_var_id, field_assigns_by_var_id).
+    decls_by_var_id maps variable identifiers to the first
+    HighLevelILVarDeclare or HighLevelILVarInit instruction declaring or
+    initializing the variable.  field_assigns_by_var_id maps variable
+    identifiers to the list of HighLevelILAssign instructions assigning
+    to struct fields of the variable, in function order.
+
+    Callers that already hold a materialized snapshot of the function's
+    instructions can pass it as instructions to avoid another walk of
+    the IL storage.
+
+    Note that variable identifiers may change across type changes in
+    the function; indexes and snapshots are stale after a reload and
+    need to be rebuilt.
     """
-    for insn in hlil_func.instructions:
+    if instructions is None:
+        instructions = hlil_func.instructions
+    decls_by_var_id = {}
+    field_assigns_by_var_id = {}
+    for insn in instructions:
+        if isinstance(insn, binja.HighLevelILVarDeclare):
+            decls_by_var_id.setdefault(insn.var.identifier, insn)
+            continue
+        if isinstance(insn, binja.HighLevelILVarInit):
+            if not isinstance(insn.dest, binja.HighLevelILStructField):
+                decls_by_var_id.setdefault(insn.dest.identifier, insn)
+            continue
         if not isinstance(insn, binja.HighLevelILAssign):
             continue
         if not isinstance(insn.dest, binja.HighLevelILStructField):
             continue
-
-        if isinstance(insn.dest.src, binja.HighLevelILVar):
-            stack_var = insn.dest.src.var
-        elif isinstance(insn.dest.src, binja.HighLevelILArrayIndex):
-            if not isinstance(insn.dest.src.src, binja.HighLevelILVar):
-                continue
-            stack_var = insn.dest.src.src.var
-        elif isinstance(insn.dest.src, binja.HighLevelILStructField):
-            if not isinstance(insn.dest.src.src, binja.HighLevelILVar):
-                continue
-            stack_var = insn.dest.src.src.var
-        elif isinstance(insn.dest.src, binja.HighLevelILDerefField):
+        stack_var = _struct_field_assign_var(insn)
+        if stack_var is None:
             continue
-        else:
-            raise NotImplementedError(f"Unhandled destination source type {type(insn.dest.src).__name__} in assign insn {insn!r}, fix plugin")
+        field_assigns_by_var_id.setdefault(stack_var.identifier, []).append(insn)
+    return decls_by_var_id, field_assigns_by_var_id
 
-        if stack_var.identifier != var_id:
-            continue
 
-        yield insn
+def build_struct_field_assign_index(hlil_func, instructions=None):
+    """
+    Index all HLIL instructions that assign to struct fields of
+    variables, keyed by variable identifier, in a single pass over
+    the function.  Callers that previously scanned the function once
+    per variable can do a dict lookup instead.
+
+    Note that variable identifiers may change across type changes
+    in the function; the index is stale after a reload.
+    """
+    _, field_assigns_by_var_id = index_function_hlil(hlil_func, instructions=instructions)
+    return field_assigns_by_var_id